@@ -2,24 +2,151 @@
 # -*- coding: utf-8 -*-
 """
 台灣即時 AQI 地圖顯示程式
-串接環境部 API 獲取全台即時 AQI 數據並使用 Folium 在地圖上標示
+串接環境部 API 獲取全台即時 AQI 數據並產生 Leaflet 互動式地圖標示
 """
 
 import os
 import requests
-import folium
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import jinja2
 from dotenv import load_dotenv
 import pandas as pd
+import numpy as np
 from datetime import datetime
-import json
-from geopy.distance import geodesic
-import csv
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import math
-from pyproj import Transformer
 
 # 載入環境變數
 load_dotenv()
 
+# TWD97 TM2 投影參數（EPSG:3826：GRS80 橢球，中央經線 121°E）
+_GRS80_A = 6378137.0
+_GRS80_F = 1 / 298.257222101
+_E2 = _GRS80_F * (2 - _GRS80_F)
+_EP2 = _E2 / (1 - _E2)
+_TM2_K0 = 0.9999
+_TM2_LON0 = math.radians(121.0)
+_TM2_FALSE_EASTING = 250000.0
+
+def wgs84_to_twd97_tm2(lats, lons):
+    """以 TM2 橫麥卡托正算公式批次將 WGS84 坐標轉換為 TWD97 (x, y) 陣列（公尺）"""
+    phi = np.radians(np.asarray(lats, dtype=np.float64))
+    lam = np.radians(np.asarray(lons, dtype=np.float64))
+    
+    e4 = _E2 * _E2
+    e6 = e4 * _E2
+    sin_phi = np.sin(phi)
+    cos_phi = np.cos(phi)
+    tan_phi = np.tan(phi)
+    
+    n = _GRS80_A / np.sqrt(1 - _E2 * sin_phi ** 2)
+    t = tan_phi ** 2
+    c = _EP2 * cos_phi ** 2
+    a = (lam - _TM2_LON0) * cos_phi
+    
+    # 赤道起算的子午線弧長
+    m = _GRS80_A * (
+        (1 - _E2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi
+        - (3 * _E2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * np.sin(2 * phi)
+        + (15 * e4 / 256 + 45 * e6 / 1024) * np.sin(4 * phi)
+        - (35 * e6 / 3072) * np.sin(6 * phi)
+    )
+    
+    xs = _TM2_FALSE_EASTING + _TM2_K0 * n * (
+        a
+        + (1 - t + c) * a ** 3 / 6
+        + (5 - 18 * t + t ** 2 + 72 * c - 58 * _EP2) * a ** 5 / 120
+    )
+    ys = _TM2_K0 * (m + n * tan_phi * (
+        a ** 2 / 2
+        + (5 - t + 9 * c + 4 * c ** 2) * a ** 4 / 24
+        + (61 - 58 * t + t ** 2 + 600 * c - 330 * _EP2) * a ** 6 / 720
+    ))
+    return xs, ys
+
+# 台北車站坐標
+TAIPEI_STATION_WGS84 = (25.0478, 121.5170)  # (緯度, 經度)
+TAIPEI_STATION_TWD97 = tuple(float(v) for v in wgs84_to_twd97_tm2(*TAIPEI_STATION_WGS84))  # (x, y) 公尺
+
+# 地圖圖例與標題 HTML
+_LEGEND_HTML = '''
+<div style="position: fixed; 
+            bottom: 50px; left: 50px; width: 180px; height: 120px; 
+            background-color: white; border:2px solid grey; z-index:9999; 
+            font-size:14px; padding: 10px">
+<h4>AQI 等級圖例</h4>
+<p><i class="fa fa-circle" style="color:#00E400"></i> 0-50 良好</p>
+<p><i class="fa fa-circle" style="color:#FFFF00"></i> 51-100 普通</p>
+<p><i class="fa fa-circle" style="color:#FF0000"></i> 101+ 不健康</p>
+</div>
+'''
+
+_TITLE_HTML = '''
+<h3 align="center" style="font-size:16px"><b>台灣即時 AQI 監測地圖</b></h3>
+'''
+
+# 精簡地圖 HTML 範本：以 Leaflet 直接繪製內嵌的 GeoJSON 測站圖層
+_MAP_TEMPLATE = jinja2.Template('''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>台灣即時 AQI 監測地圖</title>
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.4/dist/leaflet.css">
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/@fortawesome/fontawesome-free@6.2.0/css/all.min.css">
+<script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+html, body { width: 100%; height: 100%; margin: 0; padding: 0; }
+#map { position: relative; width: 100%; height: 100%; }
+</style>
+</head>
+<body>
+{{ title_html }}
+<div id="map"></div>
+{{ legend_html }}
+<script>
+var map = L.map('map', {preferCanvas: true}).setView([23.8, 121.0], 7);
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+    maxZoom: 19,
+    attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+}).addTo(map);
+
+function escapeHtml(value) {
+    var div = document.createElement('div');
+    div.textContent = value === null || value === undefined ? '' : String(value);
+    return div.innerHTML;
+}
+
+L.geoJSON({{ geojson }}, {
+    pointToLayer: function (feature, latlng) {
+        return L.circleMarker(latlng, {
+            radius: 10,
+            color: 'black',
+            weight: 1,
+            fillColor: feature.properties.color,
+            fillOpacity: 0.8
+        });
+    },
+    onEachFeature: function (feature, layer) {
+        var p = feature.properties;
+        layer.bindTooltip(escapeHtml(p.sitename) + ': AQI ' + escapeHtml(p.aqi));
+{%- if with_popup %}
+        layer.bindPopup(
+            '<b>測站:</b> ' + escapeHtml(p.sitename) + '<br>' +
+            '<b>縣市:</b> ' + escapeHtml(p.county) + '<br>' +
+            '<b>AQI:</b> ' + escapeHtml(p.aqi) + '<br>' +
+            '<b>等級:</b> ' + escapeHtml(p.level)
+        );
+{%- endif %}
+    }
+}).addTo(map);
+</script>
+</body>
+</html>
+''')
+
 class AQIMapGenerator:
     def __init__(self):
         self.api_key = os.getenv('AQI_API_KEY')
@@ -28,8 +155,15 @@ class AQIMapGenerator:
         
         self.api_url = "https://data.moenv.gov.tw/api/v2/aqx_p_432"
         self.aqi_data = None
-        self.taipei_station_wgs84 = (25.0478, 121.5170)  # 台北車站 WGS84 坐標
-        # 延遲轉換台北車站坐標，避免在初始化時調用未定義的方法
+        self.df = None
+        # 重複使用 HTTP 連線並要求 gzip 壓縮回應
+        self._session = requests.Session()
+        self._session.headers['Accept-Encoding'] = 'gzip'
+        # 暫時性的伺服器錯誤自動重試，避免整個流程失敗
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        self._session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.taipei_station_wgs84 = TAIPEI_STATION_WGS84  # 台北車站 WGS84 坐標
+        self.taipei_station_twd97 = TAIPEI_STATION_TWD97  # 台北車站 TWD97 坐標
         
     def fetch_aqi_data(self):
         """獲取環境部 AQI 數據"""
@@ -41,10 +175,10 @@ class AQIMapGenerator:
             }
             
             print("正在獲取 AQI 數據...")
-            response = requests.get(self.api_url, params=params, timeout=30)
+            response = self._session.get(self.api_url, params=params, timeout=30)
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             
             if isinstance(data, list):
                 self.aqi_data = data
@@ -52,6 +186,8 @@ class AQIMapGenerator:
                 self.aqi_data = data['value']
             else:
                 raise ValueError("API 回應格式錯誤")
+            
+            self.df = self.build_dataframe(self.aqi_data)
                 
             print(f"成功獲取 {len(self.aqi_data)} 個測站數據")
             
@@ -64,70 +200,59 @@ class AQIMapGenerator:
             print(f"數據處理錯誤: {e}")
             return False
     
-    def get_aqi_color(self, aqi_value):
-        """根據 AQI 數值返回對應顏色"""
-        try:
-            aqi = int(aqi_value)
-        except (ValueError, TypeError):
-            return '#808080'  # 灰色（無效數據）
+    def build_dataframe(self, aqi_data):
+        """將測站數據整理為欄位型別化的 DataFrame，供地圖與 CSV 共用"""
+        df = pd.DataFrame(aqi_data)
         
-        if aqi <= 50:
-            return '#00E400'  # 綠色
-        elif aqi <= 100:
-            return '#FFFF00'  # 黃色
-        else:
-            return '#FF0000'  # 紅色
-    
-    def get_aqi_level(self, aqi_value):
-        """根據 AQI 數值返回等級描述"""
-        try:
-            aqi = int(aqi_value)
-        except (ValueError, TypeError):
-            return '數據異常'
+        # 補齊缺少的欄位與個別測站缺少的數值
+        defaults = {
+            'sitename': '未知測站',
+            'county': '未知縣市',
+            'aqi': 'N/A',
+            'status': 'N/A',
+            'pollutant': 'N/A',
+            'publishtime': 'N/A',
+            'latitude': 0,
+            'longitude': 0
+        }
+        for column, default in defaults.items():
+            if column not in df.columns:
+                df[column] = default
+            else:
+                df[column] = df[column].fillna(default)
         
-        if aqi <= 50:
-            return '良好'
-        elif aqi <= 100:
-            return '普通'
-        else:
-            return '不健康'
+        # 數值欄位轉型，無效數據轉為 NaN
+        df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
+        df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
+        df['aqi_num'] = pd.to_numeric(df['aqi'], errors='coerce').round().astype('Int64')
+        df['color'], df['level'] = self.classify_aqi(df['aqi_num'])
+        
+        return df
     
-    def wgs84_to_twd97(self, lat, lon):
-        """將 WGS84 坐標轉換為 TWD97 坐標"""
-        try:
-            # 定義坐標轉換器：WGS84 (EPSG:4326) -> TWD97 (EPSG:3826)
-            transformer = Transformer.from_crs("EPSG:4326", "EPSG:3826")
-            x, y = transformer.transform(lat, lon)  # 注意順序：先緯度，後經度
-            return (x, y)  # 返回 (x, y) 坐標（公尺）
-        except Exception as e:
-            print(f"坐標轉換錯誤: {e}")
-            return None
+    def classify_aqi(self, aqi_num):
+        """依已轉型的 AQI 欄位（Int64）批次返回 (顏色陣列, 等級陣列)，缺值為灰色／數據異常"""
+        aqi_arr = aqi_num.to_numpy(dtype=np.float64, na_value=np.nan)
+        conditions = [aqi_arr <= 50, aqi_arr <= 100, aqi_arr > 100]
+        colors = np.select(conditions, ['#00E400', '#FFFF00', '#FF0000'], default='#808080')
+        levels = np.select(conditions, ['良好', '普通', '不健康'], default='數據異常')
+        return colors, levels
     
     def calculate_distance_twd97(self, lat, lon):
-        """使用 TWD97 坐標系統計算到台北車站的距離（公里）"""
+        """使用 TWD97 坐標系統計算單一測站到台北車站的距離（公里）"""
         try:
-            # 延遲初始化台北車站 TWD97 坐標
-            if not hasattr(self, 'taipei_station_twd97'):
-                self.taipei_station_twd97 = self.wgs84_to_twd97(*self.taipei_station_wgs84)
-            
-            # 將測站 WGS84 坐標轉換為 TWD97
-            station_twd97 = self.wgs84_to_twd97(lat, lon)
-            if station_twd97 is None:
-                return None
-            
-            # 使用歐幾里得距離公式計算平面距離
-            distance_meters = math.sqrt(
-                (station_twd97[0] - self.taipei_station_twd97[0])**2 + 
-                (station_twd97[1] - self.taipei_station_twd97[1])**2
-            )
-            
-            # 轉換為公里並四捨五入
-            distance_km = distance_meters / 1000
-            return round(distance_km, 2)
+            distance_km = self.calculate_distances_twd97([float(lat)], [float(lon)])[0]
+            return None if np.isnan(distance_km) else float(distance_km)
         except Exception as e:
             print(f"距離計算錯誤: {e}")
             return None
     
+    def calculate_distances_twd97(self, lats, lons):
+        """批次計算多個測站到台北車站的 TWD97 距離（公里），無效坐標回傳 NaN"""
+        xs, ys = wgs84_to_twd97_tm2(lats, lons)
+        
+        tx, ty = self.taipei_station_twd97
+        return np.round(np.hypot(xs - tx, ys - ty) / 1000.0, 2)
+    
     def export_to_csv(self, filename=None):
         """將 AQI 數據匯出為 CSV 檔案"""
         if not self.aqi_data:
@@ -142,143 +267,84 @@ class AQIMapGenerator:
             # 確保 outputs 目錄存在
             os.makedirs('outputs', exist_ok=True)
             
-            # 準備 CSV 數據
-            csv_data = []
-            for station in self.aqi_data:
-                try:
-                    lat = station.get('latitude', 0)
-                    lon = station.get('longitude', 0)
-                    distance = self.calculate_distance_twd97(lat, lon)  # 使用 TWD97 計算距離
-                    
-                    csv_data.append({
-                        '測站名稱': station.get('sitename', '未知測站'),
-                        '縣市': station.get('county', '未知縣市'),
-                        'AQI': station.get('aqi', 'N/A'),
-                        '等級': self.get_aqi_level(station.get('aqi', 'N/A')),
-                        '狀態': station.get('status', 'N/A'),
-                        '主要污染物': station.get('pollutant', 'N/A'),
-                        '緯度': lat,
-                        '經度': lon,
-                        '距離台北車站(公里)': distance,  # TWD97 計算的距離
-                        '更新時間': station.get('publishtime', 'N/A')
-                    })
-                except Exception as e:
-                    print(f"處理測站數據時發生錯誤: {e}")
-                    continue
+            df = self.df
+            
+            # 批次計算所有測站距離（TWD97）
+            dists_km = self.calculate_distances_twd97(
+                df['latitude'].to_numpy(dtype=np.float64),
+                df['longitude'].to_numpy(dtype=np.float64)
+            )
+            
+            csv_df = pd.DataFrame({
+                '測站名稱': df['sitename'],
+                '縣市': df['county'],
+                'AQI': df['aqi'],
+                '等級': df['level'],
+                '狀態': df['status'],
+                '主要污染物': df['pollutant'],
+                '緯度': df['latitude'],
+                '經度': df['longitude'],
+                '距離台北車站(公里)': dists_km,  # TWD97 計算的距離
+                '更新時間': df['publishtime']
+            })
             
-            # 寫入 CSV 檔案
-            with open(filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
-                if csv_data:
-                    fieldnames = csv_data[0].keys()
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(csv_data)
+            # 寫入 CSV 檔案（使用 1MB 緩衝區，減少系統呼叫）
+            with open(filename, 'w', newline='', encoding='utf-8-sig', buffering=1 << 20) as csvfile:
+                csv_df.to_csv(csvfile, index=False)
             
-            print(f"數據已匯出至 {filename}，共 {len(csv_data)} 筆記錄")
+            print(f"數據已匯出至 {filename}，共 {len(csv_df)} 筆記錄")
             return True
             
         except Exception as e:
             print(f"匯出 CSV 時發生錯誤: {e}")
             return False
     
-    def create_map(self):
-        """創建 AQI 地圖"""
-        if not self.aqi_data:
-            print("沒有 AQI 數據，請先執行 fetch_aqi_data()")
-            return None
-        
-        # 台灣中心座標
-        taiwan_center = [23.8, 121.0]
-        
-        # 創建地圖
-        m = folium.Map(
-            location=taiwan_center,
-            zoom_start=7,
-            tiles='OpenStreetMap'
+    def build_feature_collection(self):
+        """將有效測站整理為 GeoJSON FeatureCollection"""
+        # 排除坐標無效或為 0 的測站
+        df = self.df
+        mask = (
+            df['latitude'].notna() & df['longitude'].notna() &
+            (df['latitude'] != 0) & (df['longitude'] != 0)
         )
         
-        # 添加簡化的 AQI 圖例
-        legend_html = '''
-        <div style="position: fixed; 
-                    bottom: 50px; left: 50px; width: 180px; height: 120px; 
-                    background-color: white; border:2px solid grey; z-index:9999; 
-                    font-size:14px; padding: 10px">
-        <h4>AQI 等級圖例</h4>
-        <p><i class="fa fa-circle" style="color:#00E400"></i> 0-50 良好</p>
-        <p><i class="fa fa-circle" style="color:#FFFF00"></i> 51-100 普通</p>
-        <p><i class="fa fa-circle" style="color:#FF0000"></i> 101+ 不健康</p>
-        </div>
-        '''
-        m.get_root().html.add_child(folium.Element(legend_html))
-        
-        # 添加測站標記
-        valid_stations = 0
-        for station in self.aqi_data:
-            try:
-                # 獲取座標
-                lat = float(station.get('latitude', 0))
-                lon = float(station.get('longitude', 0))
-                
-                if lat == 0 or lon == 0:
-                    continue
-                
-                # 獲取 AQI 數值
-                aqi = station.get('aqi', 'N/A')
-                site_name = station.get('sitename', '未知測站')
-                county = station.get('county', '未知縣市')
-                pollutant = station.get('pollutant', 'N/A')
-                status = station.get('status', 'N/A')
-                
-                # 獲取顏色和等級
-                color = self.get_aqi_color(aqi)
-                level = self.get_aqi_level(aqi)
-                
-                # 創建簡化的彈出視窗內容
-                popup_content = f"""
-                <div style="font-size: 14px; min-width: 200px;">
-                <h4 style="margin: 5px 0; color: #333;">{site_name}</h4>
-                <p style="margin: 3px 0;"><b>所在地:</b> {county}</p>
-                <p style="margin: 3px 0;"><b>即時 AQI:</b> <span style="color: {color}; font-weight: bold;">{aqi}</span></p>
-                <p style="margin: 3px 0;"><b>等級:</b> {level}</p>
-                </div>
-                """
-                
-                # 添加圓形標記
-                folium.CircleMarker(
-                    location=[lat, lon],
-                    radius=10,
-                    popup=folium.Popup(popup_content, max_width=250),
-                    color='black',
-                    weight=1,
-                    fillColor=color,
-                    fillOpacity=0.8,
-                    tooltip=f"{site_name}: AQI {aqi}"
-                ).add_to(m)
-                
-                valid_stations += 1
-                
-            except (ValueError, KeyError) as e:
-                print(f"處理測站數據時發生錯誤: {e}")
-                continue
-        
-        print(f"地圖上已標示 {valid_stations} 個有效測站")
-        
-        # 添加標題
-        title_html = '''
-        <h3 align="center" style="font-size:16px"><b>台灣即時 AQI 監測地圖</b></h3>
-        '''
-        m.get_root().html.add_child(folium.Element(title_html))
+        features = []
+        columns = ['latitude', 'longitude', 'sitename', 'county', 'aqi', 'level', 'color']
+        for station in df.loc[mask, columns].itertuples(index=False):
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [station.longitude, station.latitude]},
+                'properties': {
+                    'sitename': station.sitename,
+                    'county': station.county,
+                    'aqi': station.aqi,
+                    'level': station.level,
+                    'color': station.color
+                }
+            })
         
-        return m
+        return {'type': 'FeatureCollection', 'features': features}
     
-    def save_map(self, map_obj, filename='aqi_map.html'):
-        """儲存地圖為 HTML 檔案"""
-        if map_obj is None:
-            print("無法儲存地圖：地圖物件為 None")
-            return False
+    def save_map(self, filename='aqi_map.html', with_popup=True):
+        """以精簡的 Leaflet 範本串流寫出地圖 HTML，測站數據內嵌為單一 GeoJSON；with_popup=False 時僅以 tooltip 顯示測站資訊"""
+        if not self.aqi_data:
+            print("沒有 AQI 數據，請先執行 fetch_aqi_data()")
+            return None
         
         try:
-            map_obj.save(filename)
+            feature_collection = self.build_feature_collection()
+            print(f"地圖上已標示 {len(feature_collection['features'])} 個有效測站")
+            
+            # 避免測站名稱中的 </script> 提前結束腳本區塊
+            geojson = orjson.dumps(feature_collection, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+            geojson = geojson.replace('</', '<\\/')
+            
+            _MAP_TEMPLATE.stream(
+                geojson=geojson,
+                legend_html=_LEGEND_HTML,
+                title_html=_TITLE_HTML,
+                with_popup=with_popup
+            ).dump(filename, encoding='utf-8')
             print(f"地圖已儲存為 {filename}")
             return True
         except Exception as e:
@@ -296,25 +362,28 @@ class AQIMapGenerator:
             print("無法獲取 AQI 數據，程式終止")
             return False
         
-        # 創建地圖
-        aqi_map = self.create_map()
-        if aqi_map is None:
-            print("無法創建地圖")
-            return False
-        
-        # 儲存地圖
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         map_filename = f'outputs/aqi_map_{timestamp}.html'
+        csv_filename = f'outputs/aqi_data_{timestamp}.csv'
         
         # 確保 outputs 目錄存在
         os.makedirs('outputs', exist_ok=True)
         
-        if self.save_map(aqi_map, map_filename):
+        # 同時創建儲存地圖與匯出 CSV 數據
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            map_future = executor.submit(self.save_map, map_filename)
+            csv_future = executor.submit(self.export_to_csv, csv_filename)
+            map_saved = map_future.result()
+            csv_exported = csv_future.result()
+        
+        if map_saved is None:
+            print("無法創建地圖")
+            return False
+        
+        if map_saved:
             print(f"地圖已儲存為 {map_filename}")
         
-        # 匯出 CSV 數據
-        csv_filename = f'outputs/aqi_data_{timestamp}.csv'
-        if self.export_to_csv(csv_filename):
+        if csv_exported:
             print(f"數據已匯出為 {csv_filename}")
         
         print(f"\n任務完成！")
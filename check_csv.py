@@ -1,22 +1,30 @@
 import pandas as pd
 import os
+import sys
 
-def check_csv_distances():
+# 檢查時實際使用到的欄位
+CHECK_COLUMNS = ['測站名稱', '縣市', 'AQI', '距離台北車站(公里)']
+
+def check_csv_distances(debug=False):
     # 找到最新的 CSV 檔案
-    csv_files = [f for f in os.listdir('outputs') if f.startswith('aqi_data_') and f.endswith('.csv')]
+    with os.scandir('outputs') as entries:
+        csv_files = [e for e in entries if e.name.startswith('aqi_data_') and e.name.endswith('.csv')]
     if not csv_files:
         print("找不到 CSV 檔案")
         return
     
-    latest_csv = max(csv_files)
-    csv_path = os.path.join('outputs', latest_csv)
+    # 依修改時間挑選最新的檔案
+    csv_path = max(csv_files, key=lambda e: e.stat().st_mtime).path
     
     print(f"檢查檔案: {csv_path}")
     print("=" * 50)
     
     try:
-        # 讀取 CSV 檔案
-        df = pd.read_csv(csv_path, encoding='utf-8-sig')
+        # 讀取 CSV 檔案（除錯模式才讀取全部欄位）
+        if debug:
+            df = pd.read_csv(csv_path, encoding='utf-8-sig')
+        else:
+            df = pd.read_csv(csv_path, encoding='utf-8-sig', usecols=CHECK_COLUMNS, engine='pyarrow')
         
         # 顯示基本資訊
         print(f"總記錄數: {len(df)}")
@@ -52,4 +60,4 @@ def check_csv_distances():
         print(f"讀取 CSV 檔案時發生錯誤: {e}")
 
 if __name__ == "__main__":
-    check_csv_distances()
+    check_csv_distances(debug='--debug' in sys.argv)
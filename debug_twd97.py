@@ -1,5 +1,11 @@
+import glob
+
+import numpy as np
+import pandas as pd
 from pyproj import Transformer
 
+from aqi_map import wgs84_to_twd97_tm2
+
 def test_twd97_conversion():
     # 台北車站 WGS84 坐標
     taipei_wgs84 = (25.0478, 121.5170)
@@ -13,13 +19,13 @@ def test_twd97_conversion():
     ]
     
     # 創建坐標轉換器
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3826")
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3826", always_xy=True)
     
     print("坐標轉換測試:")
     print("=" * 60)
     
     # 轉換台北車站
-    taipei_x, taipei_y = transformer.transform(taipei_wgs84[0], taipei_wgs84[1])
+    taipei_x, taipei_y = transformer.transform(taipei_wgs84[1], taipei_wgs84[0])
     print(f"台北車站 WGS84: ({taipei_wgs84[0]}, {taipei_wgs84[1]})")
     print(f"台北車站 TWD97: ({taipei_x:.2f}, {taipei_y:.2f})")
     print()
@@ -27,7 +33,7 @@ def test_twd97_conversion():
     # 轉換測站並計算距離
     for name, lat, lon in test_stations:
         try:
-            x, y = transformer.transform(lat, lon)
+            x, y = transformer.transform(lon, lat)
             distance = ((x - taipei_x)**2 + (y - taipei_y)**2)**0.5 / 1000
             
             print(f"{name}:")
@@ -38,5 +44,34 @@ def test_twd97_conversion():
         except Exception as e:
             print(f"{name} 轉換錯誤: {e}")
 
+def check_tm2_against_proj(tolerance_m=0.01):
+    """比對 aqi_map 的 TM2 公式與 PROJ (EPSG:3826) 的轉換結果"""
+    lats = [25.0478, 25.129167, 24.949028, 25.164444]
+    lons = [121.5170, 121.760056, 121.383528, 121.446111]
+    
+    # 加入 outputs 目錄中匯出的測站坐標
+    for csv_path in glob.glob('outputs/aqi_data_*.csv'):
+        df = pd.read_csv(csv_path, encoding='utf-8-sig', usecols=['緯度', '經度']).dropna()
+        df = df[(df['緯度'] != 0) & (df['經度'] != 0)]
+        lats.extend(df['緯度'])
+        lons.extend(df['經度'])
+    
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3826", always_xy=True)
+    proj_x, proj_y = transformer.transform(np.asarray(lons), np.asarray(lats))
+    tm2_x, tm2_y = wgs84_to_twd97_tm2(lats, lons)
+    max_error = float(np.max(np.hypot(tm2_x - proj_x, tm2_y - proj_y)))
+    
+    print("TM2 公式與 PROJ 比對:")
+    print("=" * 60)
+    print(f"比對點數: {len(lats)}")
+    print(f"最大誤差: {max_error:.6f} 公尺")
+    if max_error <= tolerance_m:
+        print(f"結果: 一致（誤差 <= {tolerance_m} 公尺）")
+    else:
+        print(f"結果: 不一致（誤差 > {tolerance_m} 公尺）")
+    return max_error <= tolerance_m
+
 if __name__ == "__main__":
     test_twd97_conversion()
+    print()
+    check_tm2_against_proj()
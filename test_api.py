@@ -1,5 +1,6 @@
 import os
 import requests
+import orjson
 from dotenv import load_dotenv
 
 # 載入環境變數
@@ -17,13 +18,16 @@ params = {
 print(f"API Key: {api_key}")
 print(f"URL: {api_url}")
 
+session = requests.Session()
+session.headers['Accept-Encoding'] = 'gzip'
+
 try:
-    response = requests.get(api_url, params=params, timeout=30)
+    response = session.get(api_url, params=params, timeout=30)
     print(f"Status Code: {response.status_code}")
     print(f"Response Headers: {dict(response.headers)}")
     
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
         print(f"Data Type: {type(data)}")
         
         if isinstance(data, list):